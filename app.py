@@ -1,12 +1,17 @@
-from flask import Flask, request
+from flask import Flask, request, jsonify
 
 from feishu_ctf.api import *
 from feishu_ctf.handlers import *
 
 from time import strftime
+import hmac
+import os
 
 app = Flask(__name__)
 
+# /stats is disabled unless a token is set, it is sent in the X-Stats-Token header
+STATS_TOKEN = os.environ.get('FEISHU_CTF_STATS_TOKEN')
+
 @app.route('/callback', methods=['POST'])
 def callback():
     """feishu callback procedure
@@ -20,6 +25,16 @@ def callback():
         return str(e), 200
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    """solve statistics, of one event if `event` is given
+    """
+    token = request.headers.get('X-Stats-Token', '')
+    if not STATS_TOKEN or not hmac.compare_digest(token.encode(), STATS_TOKEN.encode()):
+        return 'invalid token', 403
+    return jsonify(CTF.timeline.stats(request.args.get('event')))
+
+
 @app.route("/", methods=['GET'])
 def index():
     return "2019 so nb"
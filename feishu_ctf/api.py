@@ -1,8 +1,15 @@
-from typing import Optional, Union, Any, Dict
+from typing import Optional, Union, Any, Dict, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
 import requests
 import os
 import json
 import logging
+import random
+import threading
+import time
+import uuid
 
 logger = logging.getLogger('feishu-ctf')
 
@@ -11,6 +18,121 @@ class FeishuException(Exception):
     pass
 
 
+class DeadlineExceeded(FeishuException):
+    pass
+
+
+class TransientFeishuException(FeishuException):
+    """a failure that may go away when retried.
+    `throttled` ones were rejected before feishu did anything,
+    so they are safe to retry for any endpoint.
+    """
+    def __init__(self, msg: str, throttled: bool = False) -> None:
+        super().__init__(msg)
+        self.throttled = throttled
+
+
+class CircuitOpen(FeishuException):
+    pass
+
+
+class Deadline:
+    """time budget of a single callback.
+
+    the active deadline is kept per thread, every FeishuClient request
+    made while it is active uses the remaining budget as its timeout.
+    """
+    _local = threading.local()
+
+    def __init__(self, budget: float) -> None:
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def fits(self, cost: float) -> bool:
+        return self.remaining() >= cost
+
+    @staticmethod
+    def current() -> Optional['Deadline']:
+        return getattr(Deadline._local, 'deadline', None)
+
+    @contextmanager
+    def activate(self):
+        prev = Deadline.current()
+        Deadline._local.deadline = self
+        try:
+            yield self
+        finally:
+            Deadline._local.deadline = prev
+
+
+class RateLimiter:
+    """spaces out calls so that at most `rate` of them start per second,
+    shared between all threads using the same limiter
+    """
+    def __init__(self, rate: float) -> None:
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, max_delay: Optional[float] = None) -> bool:
+        """waits for the next slot, unless it is more than
+        `max_delay` seconds away. returns whether a slot was taken.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            if max_delay is not None and slot - now > max_delay:
+                return False
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+        return True
+
+
+class CircuitBreaker:
+    """fails fast after `threshold` transient failures in a row.
+
+    once open, calls are refused for `cooldown` seconds, then a single
+    probe is let through: success closes the breaker, failure opens it again.
+    """
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def release(self) -> None:
+        """ends a probe that told nothing about feishu"""
+        with self.lock:
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
 class FeishuClient:
     APP_VERIFICATION_TOKEN = os.environ['FEISHU_VERIFICATION_TOKEN']
     APP_SECRET = os.environ['FEISHU_SECRET']
@@ -22,13 +144,36 @@ class FeishuClient:
     BOT_INFO_URL = 'https://open.feishu.cn/open-apis/bot/v3/info'
     CREATE_CHAT_URL = 'https://open.feishu.cn/open-apis/im/v1/chats'
     CHAT_INFO_URL = 'https://open.feishu.cn/open-apis/im/v1/chats/{}'
-    LIST_CHAT_URL = 'https://open.feishu.cn/open-apis/im/v1/chats'
+    LIST_CHAT_URL = 'https://open.feishu.cn/open-apis/im/v1/chats?page_size=100'
+    UPDATE_CHAT_URL = 'https://open.feishu.cn/open-apis/im/v1/chats/{}'
     USER_INFO_URL = 'https://open.feishu.cn/open-apis/contact/v1/user/batch_get?employee_ids={}'
     CREATE_DOC_URL = 'https://open.feishu.cn/open-apis/doc/v2/create'
     GET_DOC_URL = 'https://open.feishu.cn/open-apis/doc/v2/{}/content'
     SET_DOC_PERM = 'https://open.feishu.cn/open-apis/drive/permission/public/update'
     UPDATE_DOC_URL = 'https://open.feishu.cn/open-apis/doc/v2/{}/batch_update'
 
+    # feishu allows 50 messages per second per app, evenly spaced
+    # sends use all of it, so 80 chats take about 1.6s
+    BROADCAST_WORKERS = 16
+    BROADCAST_RATE = 50
+
+    # timeout of a request made outside of any deadline
+    REQUEST_TIMEOUT = 10.0
+    # rough cost of a single api call, used to decide whether
+    # a step still fits into the remaining budget
+    CALL_COST = 0.3
+
+    # retries of a transient failure, with full jitter backoff
+    # of up to BACKOFF_BASE * 2 ** attempt seconds
+    MAX_RETRIES = 3
+    BACKOFF_BASE = 0.2
+    # error codes meaning the request was rejected by rate limiting
+    THROTTLED_CODES = {99991400, 230020, 11232}
+    # posts that have no side effect, or none when repeated
+    IDEMPOTENT_POSTS = {GET_APP_ACCESS_TOKEN_URL, BOT_INFO_URL}
+
+    BREAKER = CircuitBreaker(threshold=5, cooldown=10.0)
+
     bot_info: Dict[str, Any]
 
     def __init__(self) -> None:
@@ -48,14 +193,101 @@ class FeishuClient:
             headers
         ))
 
-        res = requests.request(method, url, json=data, headers=headers)
-        res = res.json()
+        idempotent = FeishuClient.is_idempotent(url, method, data)
+        attempt = 0
+        while True:
+            deadline = Deadline.current()
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceeded('deadline exceeded before {} {}'.format(method, url))
+            if not FeishuClient.BREAKER.allow():
+                raise CircuitOpen('Feishu API is degraded, not requesting {}'.format(url))
+
+            try:
+                res = FeishuClient.request_once(url, method, data, headers)
+            except DeadlineExceeded:
+                # our own budget ran out, this says nothing about feishu
+                FeishuClient.BREAKER.release()
+                raise
+            except TransientFeishuException as e:
+                FeishuClient.BREAKER.record_failure()
+                if not (e.throttled or idempotent) or \
+                    not FeishuClient.backoff(attempt):
+                    raise
+                logger.info('retrying {} {} after: {}'.format(method, url, e))
+                attempt += 1
+                continue
+            except FeishuException:
+                # feishu answered, it is not degraded
+                FeishuClient.BREAKER.record_success()
+                raise
+            except Exception:
+                # anything unexpected must not leave a probe running forever
+                FeishuClient.BREAKER.record_failure()
+                raise
+            FeishuClient.BREAKER.record_success()
+            return res
+
+    @staticmethod
+    def request_once(url: str,
+        method: str,
+        data: Dict[str, Any] = None,
+        headers: Optional[Dict[str, str]] = None) -> Dict[Any, Any]:
+        timeout = FeishuClient.REQUEST_TIMEOUT
+        deadline = Deadline.current()
+        if deadline is not None:
+            timeout = min(timeout, deadline.remaining())
+
+        try:
+            res = requests.request(method, url, json=data, headers=headers, timeout=timeout)
+        except requests.Timeout:
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceeded('deadline exceeded during {} {}'.format(method, url))
+            raise TransientFeishuException('timeout on {} {}'.format(method, url))
+        except requests.ConnectionError as e:
+            raise TransientFeishuException('connection error on {} {}: {}'.format(method, url, e))
+        except requests.RequestException as e:
+            raise TransientFeishuException('request error on {} {}: {}'.format(method, url, e))
+
+        if res.status_code == 429:
+            raise TransientFeishuException('Feishu API throttled', throttled=True)
+        if res.status_code >= 500:
+            raise TransientFeishuException('Feishu API error with HTTP {}'.format(res.status_code))
+        try:
+            res = res.json()
+        except ValueError:
+            raise FeishuException('Feishu API error with HTTP {} and no json body'.format(res.status_code))
         code = res.get('code', -1)
+        if code in FeishuClient.THROTTLED_CODES:
+            raise TransientFeishuException('Feishu API throttled with {}'.format(
+                res.get('msg', '(no msg)')), throttled=True)
         if code != 0:
             raise FeishuException('Feishu API error with {}'.format(res.get('msg', '(no msg)')))
         else:
             return res
 
+    @staticmethod
+    def is_idempotent(url: str, method: str, data: Optional[Dict[str, Any]]) -> bool:
+        """whether sending the request twice has the same effect as sending it once"""
+        if method in ('get', 'put') or url in FeishuClient.IDEMPOTENT_POSTS:
+            return True
+        # messages carrying a uuid are de-duplicated by feishu
+        return url.strip().startswith(FeishuClient.MESSAGE_URL.strip()) and \
+            data is not None and 'uuid' in data
+
+    @staticmethod
+    def backoff(attempt: int) -> bool:
+        """sleeps before retry number `attempt`, returns False
+        if there are no retries or no budget left
+        """
+        if attempt >= FeishuClient.MAX_RETRIES:
+            return False
+        delay = random.uniform(0, FeishuClient.BACKOFF_BASE * 2 ** attempt)
+        deadline = Deadline.current()
+        if deadline is not None and not deadline.fits(delay + FeishuClient.CALL_COST):
+            return False
+        time.sleep(delay)
+        return True
+
     @staticmethod
     def post(url: str,
         data: Dict[str, Any],
@@ -78,6 +310,15 @@ class FeishuClient:
 
         return self.post(url, data, headers)
 
+    def authorized_put(self,
+        url: str,
+        data: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        if headers is None:
+            headers = {}
+        headers['Authorization'] = 'Bearer ' + self.access_token
+        return self.request(url, 'put', data, headers)
+
     def authorized_get(self,
         url: str,
         data: Dict[str, Any] = None,
@@ -117,8 +358,14 @@ class FeishuClient:
         url = FeishuClient.CHAT_INFO_URL.format(chat_id)
         return self.authorized_get(url)['data']
 
-    def list_chats(self) -> Dict[str, Any]:
+    def update_chat_description(self, chat_id: str, description: str) -> Dict[str, Any]:
+        url = FeishuClient.UPDATE_CHAT_URL.format(chat_id)
+        return self.authorized_put(url, {'description': description})
+
+    def list_chats(self, page_token: Optional[str] = None) -> Dict[str, Any]:
         url = FeishuClient.LIST_CHAT_URL
+        if page_token:
+            url += '&page_token=' + quote(page_token)
         return self.authorized_get(url)['data']
 
 
@@ -129,10 +376,50 @@ class FeishuClient:
         data = {
             'receive_id': chat_id,
             'content': json.dumps(content),
-            'msg_type': msg_type
+            'msg_type': msg_type,
+            # same uuid on every retry, so feishu sends it only once
+            'uuid': str(uuid.uuid4())
         }
         return self.authorized_post(url, data)
 
+    def broadcast_message(self,
+        chat_ids: Iterable[str],
+        content: Dict[str, Any], msg_type: str = 'text',
+        reserve: float = 0.0) -> Tuple[List[str], List[str], List[str]]:
+        """sends the same message to every chat in parallel.
+        under a deadline, sends that would leave less than `reserve` seconds
+        are not started. returns (delivered, failed, not started) chat ids
+        """
+        limiter = RateLimiter(FeishuClient.BROADCAST_RATE)
+        deadline = Deadline.current()
+
+        def send(chat_id):
+            max_delay = None
+            if deadline is not None:
+                max_delay = deadline.remaining() - FeishuClient.CALL_COST - reserve
+            if not limiter.wait(max_delay):
+                return None
+            try:
+                if deadline is None:
+                    self.send_message(chat_id, content, msg_type)
+                else:
+                    with deadline.activate():
+                        self.send_message(chat_id, content, msg_type)
+                return True
+            except Exception as e:
+                logger.error('broadcast to {} failed: {}'.format(chat_id, e))
+                return False
+
+        chat_ids = list(chat_ids)
+        delivered, failed, rest = [], [], []
+        with ThreadPoolExecutor(max_workers=FeishuClient.BROADCAST_WORKERS) as pool:
+            for chat_id, ok in zip(chat_ids, pool.map(send, chat_ids)):
+                if ok is None:
+                    rest.append(chat_id)
+                else:
+                    (delivered if ok else failed).append(chat_id)
+        return delivered, failed, rest
+
     def get_user_name(self, user_id: str):
         url = FeishuClient.USER_INFO_URL.format(user_id)
         return self.authorized_get(url)['data']['user_infos'][0]['name']
@@ -146,11 +433,12 @@ class FeishuClient:
 
     def create_doc(self, title: str):
         j = {"title":{"elements":[{"type":"textRun","textRun":{"text":title,"style":{}}}]},"body":{}}
-        ret = self.authorized_post(FeishuClient.CREATE_DOC_URL, \
+        return self.authorized_post(FeishuClient.CREATE_DOC_URL, \
             {"FolderToken":"", "Content": json.dumps(j)})['data']
-        self.authorized_post(FeishuClient.SET_DOC_PERM, \
-            {'token': ret['objToken'], 'type': 'doc', 'link_share_entity': 'tenant_editable'})
-        return ret
+
+    def share_doc(self, doc_token: str):
+        return self.authorized_post(FeishuClient.SET_DOC_PERM, \
+            {'token': doc_token, 'type': 'doc', 'link_share_entity': 'tenant_editable'})
 
     def update_doc(self, doc_token: str, data: Dict[str, Any]):
         return self.authorized_post(FeishuClient.UPDATE_DOC_URL.format(doc_token), data)
@@ -1,7 +1,21 @@
 from enum import Enum
+import json
+import logging
+import os
+import time
+import zlib
+from feishu_ctf.timeline import Timeline
+
+logger = logging.getLogger('feishu-ctf')
 
 class CtfManager:
-	def __init__(self):
+	# events not touched for this many seconds get archived
+	ARCHIVE_AGE = int(os.environ.get('CTF_ARCHIVE_AGE', 3 * 24 * 3600))
+	# the idle check runs at most once per this many seconds
+	ARCHIVE_CHECK_INTERVAL = 600
+	ARCHIVE_DIR = os.environ.get('CTF_ARCHIVE_DIR', '/tmp/feishu-ctf-archive')
+
+	def __init__(self, archive_dir = None):
 		# maps CTF name to Event
 		self._events = dict()
 		# map group_id to its information.
@@ -14,36 +28,204 @@ class CtfManager:
 		# which further maps challenge name to group_id
 		self._event_map = dict()
 		# data in these 3 fields should always be consistent
+		# maps group_id of every archived event to the event name,
+		# this is all that is kept in memory for archived events
+		self._archive_dir = archive_dir or CtfManager.ARCHIVE_DIR
+		self._archived = self._load_archive_index()
+		self._last_archive_check = time.time()
+		# timestamped log of challenge creation, state changes and workers
+		self.timeline = self._load_timeline()
 	def get_event(self, name):
-		return self._events.get(name)
+		if name not in self._events and os.path.exists(self._archive_path(name)):
+			self._restore(name)
+		ret = self._events.get(name)
+		if ret is not None:
+			ret.last_active = time.time()
+		return ret
+	def _touch(self, event):
+		# keeps the event from being archived as idle
+		self._events[event].last_active = time.time()
+	def has_event(self, name):
+		# unlike get_event, this does not reload archived events
+		return name in self._events or os.path.exists(self._archive_path(name))
+	def is_loaded(self, name):
+		# whether the event is in memory, i.e. known and not archived
+		return name in self._events
+	def has_group(self, group_id):
+		# unlike get_chall_from_group, this does not reload archived events
+		return group_id in self._group_map or group_id in self._archived
 	def new_event(self, name, group_id, doc):
 		self._events[name] = Event()
 		self._group_map[group_id] = (name, None)
 		self._event_map[name] = (group_id, dict(), doc)
 	def get_event_from_group(self, group_id):
-		return self._group_map.get(group_id, (None,))[0]
-	def get_chall_from_group(self, group_id):
-		return self._group_map.get(group_id)
+		return self.get_chall_from_group(group_id, (None,))[0]
+	def get_chall_from_group(self, group_id, default = None):
+		if group_id in self._archived:
+			self._restore(self._archived[group_id])
+		ret = self._group_map.get(group_id)
+		if ret is None:
+			return default
+		self._touch(ret[0])
+		return ret
 	def add_challenge(self, event, chall, category, group_id):
 		self._events[event].add_chall(chall, category)
 		self._group_map[group_id] = (event, chall)
 		self._event_map[event][1][chall] = group_id
+	def new_challenge(self, event, chall, category, group_id):
+		# like add_challenge, but for a challenge that is created right now
+		self.add_challenge(event, chall, category, group_id)
+		self.timeline.record_create(event, chall, category)
+		self._flush_timeline()
+	def set_state(self, event, chall, state):
+		self._events[event].get_chall(chall).state = state
+		self._touch(event)
+		self.timeline.record_state(event, chall, state.value)
+		self._flush_timeline()
+	def add_person(self, event, chall, p):
+		self._events[event].get_chall(chall).add_person(p)
+		self._touch(event)
+		self.timeline.record_person(event, chall, p)
+		self._flush_timeline()
 	def get_main_chat(self, event):
 		return self._event_map[event][0]
 	def get_chall_chat(self, event, chall):
 		return self._event_map[event][1].get(chall)
 	def get_doc_token(self, event):
 		return self._event_map[event][2]
+	def set_doc_token(self, event, doc):
+		main_group, chall_groups, _ = self._event_map[event]
+		self._event_map[event] = (main_group, chall_groups, doc)
+	def get_chall_chats(self, event, pred = None):
+		# returns a dict mapping challenge name to its group_id,
+		# keeping only challenges for which pred(chall) is true
+		ctf = self._events[event]
+		return {k: v for k, v in self._event_map[event][1].items()
+			if pred is None or pred(ctf.get_chall(k))}
 	def get_debug_info(self):
 		ret = "_event_map: {}\n".format(self._event_map)
 		ret += "_group_map: {}\n".format(self._group_map)
 		ret += "_events: {}\n".format(self._events)
+		ret += "archived events: {}\n".format(len(set(self._archived.values())))
 		return ret
 
+	def archive(self, name):
+		"""writes an event to the archive directory and drops it from memory.
+		it is restored transparently on the next lookup.
+		"""
+		ctf = self._events[name]
+		main_group, chall_groups, doc = self._event_map[name]
+		challs = []
+		for chall_name, group_id in chall_groups.items():
+			c = ctf.get_chall(chall_name)
+			challs.append([chall_name, group_id, sorted(c.categories), \
+				c.state.value, sorted(c.workings)])
+
+		# the file is complete before the event leaves memory
+		data = [name, main_group, doc, ctf.last_active, challs]
+		os.makedirs(self._archive_dir, exist_ok=True)
+		path = self._archive_path(name)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode()))
+		os.replace(path + '.tmp', path)
+
+		del self._events[name]
+		del self._event_map[name]
+		for group_id in list(chall_groups.values()) + [main_group]:
+			del self._group_map[group_id]
+			self._archived[group_id] = name
+		self._save_archive_index()
+
+	def archive_idle(self, now = None):
+		"""archives every event idle for longer than ARCHIVE_AGE,
+		returns the archived event names
+		"""
+		now = time.time() if now is None else now
+		if now - self._last_archive_check < CtfManager.ARCHIVE_CHECK_INTERVAL:
+			return []
+		self._last_archive_check = now
+		idle = [k for k, v in self._events.items()
+			if now - v.last_active > CtfManager.ARCHIVE_AGE]
+		for name in idle:
+			self.archive(name)
+		return idle
+
+	def _restore(self, name):
+		path = self._archive_path(name)
+		try:
+			with open(path, 'rb') as f:
+				_, main_group, doc, last_active, challs = \
+					json.loads(zlib.decompress(f.read()).decode())
+		except (OSError, ValueError, TypeError, zlib.error) as e:
+			# missing or broken file, forget the event instead of
+			# failing every message in its chats
+			logger.error('dropping archived event {}: {}'.format(name, e))
+			self._archived = {k: v for k, v in self._archived.items() if v != name}
+			self._save_archive_index()
+			if os.path.exists(path):
+				os.remove(path)
+			return
+		self.new_event(name, main_group, doc)
+		ctf = self._events[name]
+		for chall_name, group_id, categories, state, workings in challs:
+			self.add_challenge(name, chall_name, None, group_id)
+			c = ctf.get_chall(chall_name)
+			c.categories = set(categories)
+			c.state = ChallState(state)
+			c.workings = set(workings)
+		ctf.last_active = last_active
+
+		self._archived = {k: v for k, v in self._archived.items() if v != name}
+		os.remove(path)
+		self._save_archive_index()
+
+	def _archive_path(self, name):
+		# hex keeps arbitrary event names safe as file names
+		return os.path.join(self._archive_dir, name.encode().hex() + '.json.z')
+
+	def _timeline_path(self):
+		return os.path.join(self._archive_dir, 'timeline.bin')
+
+	def _load_timeline(self):
+		try:
+			return Timeline.load(self._timeline_path())
+		except FileNotFoundError:
+			return Timeline()
+		except Exception as e:
+			# an unreadable log must not take the app down,
+			# it is overwritten on the next flush
+			logger.error('failed to load timeline: {}'.format(e))
+			return Timeline()
+
+	def _flush_timeline(self):
+		# rows stay buffered and are retried with the next record on failure
+		try:
+			os.makedirs(self._archive_dir, exist_ok=True)
+			self.timeline.flush(self._timeline_path())
+		except OSError as e:
+			logger.error('failed to flush timeline: {}'.format(e))
+
+	def _index_path(self):
+		return os.path.join(self._archive_dir, 'index.json')
+
+	def _load_archive_index(self):
+		try:
+			with open(self._index_path()) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return dict()
+
+	def _save_archive_index(self):
+		tmp = self._index_path() + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump(self._archived, f, separators=(',', ':'))
+		os.replace(tmp, self._index_path())
+
 class Event:
 	def __init__(self):
 		self._challenges = dict()
 		# maps challenge name to Challenge
+		self.last_active = time.time()
 	def get_chall(self, name):
 		return self._challenges.get(name)
 	def add_chall(self, name, category):
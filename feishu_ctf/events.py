@@ -0,0 +1,79 @@
+from typing import Any, Dict, List, Optional
+
+# use the fastest json decoder available
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        from json import loads
+
+
+class EventHeader:
+    __slots__ = ('event_id', 'event_type', 'token', 'create_time')
+
+    def __init__(self, header: Dict[str, Any]) -> None:
+        self.event_id: Optional[str] = header.get('event_id')
+        self.event_type: Optional[str] = header.get('event_type')
+        self.token: Optional[str] = header.get('token')
+        self.create_time: Optional[str] = header.get('create_time')
+
+
+class Sender:
+    __slots__ = ('sender_type', 'open_id', 'user_id')
+
+    def __init__(self, sender: Dict[str, Any]) -> None:
+        ids = sender.get('sender_id') or {}
+        self.sender_type: Optional[str] = sender.get('sender_type')
+        self.open_id: Optional[str] = ids.get('open_id')
+        self.user_id: Optional[str] = ids.get('user_id')
+
+
+class Mention:
+    __slots__ = ('key', 'name', 'open_id')
+
+    def __init__(self, mention: Dict[str, Any]) -> None:
+        self.key: Optional[str] = mention.get('key')
+        self.name: Optional[str] = mention.get('name')
+        self.open_id: Optional[str] = (mention.get('id') or {}).get('open_id')
+
+
+class Message:
+    """a received message, `content` is only decoded when `text` is first used
+    """
+    __slots__ = ('message_id', 'chat_id', 'chat_type', 'message_type',
+        'mentions', 'content', '_text')
+
+    def __init__(self, message: Dict[str, Any]) -> None:
+        self.message_id: Optional[str] = message.get('message_id')
+        self.chat_id: str = message['chat_id']
+        self.chat_type: Optional[str] = message.get('chat_type')
+        self.message_type: Optional[str] = message.get('message_type')
+        self.mentions: List[Mention] = [Mention(m) for m in message.get('mentions') or []]
+        self.content: str = message.get('content', '{}')
+        self._text: Optional[str] = None
+
+    def mentions_open_id(self, open_id: str) -> bool:
+        return any(m.open_id == open_id for m in self.mentions)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = loads(self.content).get('text', '')
+        return self._text
+
+    @property
+    def command(self) -> str:
+        """text following the leading mention, empty if there is none
+        """
+        splits = self.text.split(maxsplit=1)
+        return splits[1] if len(splits) > 1 else ''
+
+
+class MessageEvent:
+    __slots__ = ('sender', 'message')
+
+    def __init__(self, event: Dict[str, Any]) -> None:
+        self.sender = Sender(event.get('sender') or {})
+        self.message = Message(event['message'])
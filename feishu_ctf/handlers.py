@@ -1,9 +1,14 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
+from collections import Counter
 from flask.json import jsonify
 import json
+import os
+import threading
 import traceback
 from flask import Request, Response
-from feishu_ctf.api import API, DocAPI
+from feishu_ctf.api import API, DocAPI, Deadline, DeadlineExceeded, FeishuException, logger
+from feishu_ctf.events import EventHeader, MessageEvent, loads
+from feishu_ctf.rehydrate import EVENT_CHAT_DESCRIPTION, REHYDRATION, rehydrate
 from feishu_ctf.ctf import CTF, ChallState
 
 
@@ -20,12 +25,12 @@ from feishu_ctf.ctf import CTF, ChallState
 HANDLED_EVENTS = set()
 HANDLED_EVENTS_BUFFER = set()
 
-def is_event_repeated(event_header: Dict[str, str]) -> bool:
+def is_event_repeated(event_header: EventHeader) -> bool:
     """checks if a event is a repeated event. If not, remember that, any other should not
     """
     global HANDLED_EVENTS, HANDLED_EVENTS_BUFFER
 
-    event_id = event_header.get('event_id')
+    event_id = event_header.event_id
     if event_id is None:
         return False
 
@@ -44,6 +49,80 @@ def is_event_repeated(event_header: Dict[str, str]) -> bool:
     return True
 
 
+# the function is killed after 3 seconds, leave some room
+# for flask and for sending the response.
+CALLBACK_BUDGET = float(os.environ.get('FEISHU_CTF_BUDGET', 2.5))
+
+# maps command handler name to the number of times it ran out of budget,
+# either by deferring a step or by hitting the deadline
+DEADLINE_MISSES = Counter()
+
+# whether state lost on a cold start is rebuilt from feishu
+REHYDRATE = os.environ.get('FEISHU_CTF_REHYDRATE', '1') != '0'
+
+# a deferred step is given up after this many failed attempts
+MAX_STEP_ATTEMPTS = 3
+# budget kept for the command itself when running deferred steps
+COMMAND_RESERVE = 1.0
+
+
+class DeferredStep:
+    __slots__ = ('name', 'chat_id', 'cost', 'func', 'args', 'attempts', 'error')
+
+    def __init__(self, name: str, chat_id: str, cost: float, func: Callable, args) -> None:
+        self.name = name
+        self.chat_id = chat_id
+        self.cost = cost
+        self.func = func
+        self.args = args
+        self.attempts = 0
+        self.error: Optional[str] = None
+
+    def __str__(self) -> str:
+        return '{}.{} (attempts: {}, last error: {})'.format(
+            self.name, self.func.__name__, self.attempts, self.error)
+
+
+# steps that did not fit into the budget of their callback.
+# the instance may be frozen as soon as the response is sent,
+# so they are run at the start of the following callbacks
+# instead of in a background thread.
+PENDING_STEPS: List[DeferredStep] = []
+PENDING_LOCK = threading.Lock()
+
+
+def run_pending_steps() -> None:
+    """runs deferred steps in order while they fit into the budget,
+    stops at the first failure
+    """
+    deadline = Deadline.current()
+    while True:
+        with PENDING_LOCK:
+            if len(PENDING_STEPS) == 0 or (deadline is not None and \
+                not deadline.fits(PENDING_STEPS[0].cost + COMMAND_RESERVE)):
+                return
+            step = PENDING_STEPS.pop(0)
+
+        try:
+            step.func(*step.args)
+            continue
+        except Exception as e:
+            step.attempts += 1
+            step.error = str(e)
+            logger.error('deferred step {} failed: {}'.format(step, traceback.format_exc()))
+
+        if step.attempts < MAX_STEP_ATTEMPTS:
+            with PENDING_LOCK:
+                PENDING_STEPS.append(step)
+        else:
+            try:
+                API.send_message(step.chat_id, {'text': \
+                    "Error: gave up on deferred step {}".format(step)})
+            except Exception as e:
+                logger.error('failed to report deferred step {}: {}'.format(step, e))
+        return
+
+
 class FeishuHandlerException(Exception):
     pass
 
@@ -87,8 +166,8 @@ class CommandHandler:
             name, self.help(), name, args_help
         )
 
-    def handle(self, event: Dict[str, Any]) -> Response:
-        content: str = json.loads(event['message']['content'])['text'].split(maxsplit=1)[1]
+    def handle(self, event: MessageEvent) -> Response:
+        content: str = event.message.command
         cmd = content.split(maxsplit=len(self.args()))
         name = cmd[0]
         cmd = cmd[1:]
@@ -97,9 +176,37 @@ class CommandHandler:
         #     raise FeishuHandlerException('expected {} args got {}: {}'.format(arg_len, len(cmd)), self.usage(name))
         return self.handle_command(cmd, event)
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
         raise NotImplementedError()
 
+    def defer(self, chat_id: str, cost: float, func: Callable, *args) -> None:
+        """queues `func` to run in a later callback, failures
+        after the last attempt are reported to `chat_id`
+        """
+        name = type(self).__name__
+        with PENDING_LOCK:
+            PENDING_STEPS.append(DeferredStep(name, chat_id, cost, func, args))
+
+    def run_or_defer(self, chat_id: str, cost: float, func: Callable, *args) -> bool:
+        """runs `func` now if `cost` seconds still fit into the callback
+        deadline, otherwise defers it. if the deadline is hit while it runs,
+        it is deferred as well, so `func` has to be safe to run again.
+        returns whether it ran to the end now.
+        """
+        deadline = Deadline.current()
+        name = type(self).__name__
+        if deadline is None or deadline.fits(cost):
+            try:
+                func(*args)
+                return True
+            except DeadlineExceeded as e:
+                logger.info('step of {} hit the deadline, deferring: {}'.format(name, e))
+        else:
+            logger.info('deferring step of {}, {:.2f}s left'.format(name, deadline.remaining()))
+        DEADLINE_MISSES[name] += 1
+        self.defer(chat_id, cost, func, *args)
+        return False
+
 
 class VerificationHandler(FeishuHandler):
     def handle(self, info: Dict[str, Any]) -> Response:
@@ -124,8 +231,8 @@ class NewChallCommand(CommandHandler):
     def args():
         return [CommandArg('category'), CommandArg('name')]
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
 
         # some basic checks
         if len(cmd) != 2:
@@ -149,11 +256,33 @@ class NewChallCommand(CommandHandler):
         name = '{}-{}'.format(event_name, chall_name)
         description = '{}: {}'.format(name, chall_category)
         new_chat_info = API.create_chat_group(name, description)
+
+        # update manager right away, so that the chat never exists
+        # without the challenge even if we are killed later on
+        CTF.new_challenge(event_name, chall_name, \
+            chall_category, new_chat_info['chat_id'])
+
         content = {'chat_id': new_chat_info['chat_id']}
         API.send_message(chat_id, content, msg_type='share_chat')
 
-        # update doc
+        # update doc, takes up to 4 calls
+        if CTF.get_doc_token(event_name) is None:
+            API.send_message(chat_id, {'text': \
+                "The doc of this event is not ready, the challenge will be added to it later"})
+            self.defer(chat_id, 4 * API.CALL_COST, self.update_doc, \
+                event_name, chall_category, chall_name)
+        else:
+            self.run_or_defer(chat_id, 4 * API.CALL_COST, self.update_doc, \
+                event_name, chall_category, chall_name)
+
+        API.send_message(chat_id, {'text': "Adding challenge success!"})
+        return Response("OK", 200)
+
+    @staticmethod
+    def update_doc(event_name: str, chall_category: str, chall_name: str) -> None:
         tok = CTF.get_doc_token(event_name)
+        if tok is None:
+            raise FeishuHandlerException('{} has no doc yet'.format(event_name))
         doc = API.get_doc(tok)
         body_blocks = json.loads(doc['content'])['body']['blocks']
         loc = None
@@ -175,13 +304,6 @@ class NewChallCommand(CommandHandler):
             API.update_doc(tok, \
                 DocAPI.make_insert_req(doc['revision'], "%s | open | working: " % chall_name, 3, loc))
 
-        # update manager
-        CTF.add_challenge(event_name, chall_name, \
-            chall_category, new_chat_info['chat_id'])
-
-        API.send_message(chat_id, {'text': "Adding challenge success!"})
-        return Response("OK", 200)
-
 class NewEventCommand(CommandHandler):
     @staticmethod
     def help():
@@ -191,8 +313,8 @@ class NewEventCommand(CommandHandler):
     def args():
         return [CommandArg('CTF name')]
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
         if len(cmd) != 1:
             API.send_message(chat_id, {'text': "Error: command should be 'newctf event_name'"})
             return Response('liangjs said: Error happened! No!', 200)
@@ -210,16 +332,37 @@ class NewEventCommand(CommandHandler):
             {'chat_id': new_chat_info['chat_id']}, \
             msg_type='share_chat')
 
-        # create doc
-        doc = API.create_doc(ctf_name)
-        API.send_message(chat_id, {'text': doc['url']})
+        # add to CTF manager, the doc is attached once created
+        CTF.new_event(ctf_name, new_chat_info['chat_id'], None)
 
-        # add to CTF manager
-        CTF.new_event(ctf_name, new_chat_info['chat_id'], doc['objToken'])
+        # create doc, then share it in a separate step
+        self.run_or_defer(chat_id, API.CALL_COST, self.create_doc, \
+            chat_id, ctf_name, new_chat_info['chat_id'])
 
         API.send_message(chat_id, {'text': "Adding CTF success!"})
         return Response("OK", 200)
 
+    def create_doc(self, chat_id: str, ctf_name: str, main_chat_id: str) -> None:
+        # creating is not idempotent, the token is stored right away
+        # and everything after it is a step of its own, so that
+        # retrying the rest never creates another doc
+        doc = API.create_doc(ctf_name)
+        CTF.set_doc_token(ctf_name, doc['objToken'])
+        self.run_or_defer(chat_id, 3 * API.CALL_COST, self.share_doc, \
+            chat_id, ctf_name, main_chat_id, doc['objToken'], doc['url'])
+
+    @staticmethod
+    def share_doc(chat_id: str, ctf_name: str, main_chat_id: str, doc_token: str, url: str) -> None:
+        API.share_doc(doc_token)
+        API.send_message(chat_id, {'text': url})
+        # remember the doc in the chat, so that it can be rehydrated.
+        # only a nice to have, the bot may not be allowed to edit the chat
+        try:
+            API.update_chat_description(main_chat_id, \
+                EVENT_CHAT_DESCRIPTION.format(ctf_name, doc_token))
+        except FeishuException as e:
+            logger.error('failed to record doc of {} in its chat: {}'.format(ctf_name, e))
+
 
 class ShowChatCommand(CommandHandler):
     @staticmethod
@@ -230,8 +373,8 @@ class ShowChatCommand(CommandHandler):
     def args():
         return [CommandArg('chall')]
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
         if len(cmd) > 1:
             API.send_message(chat_id, {'text': "Error: command should be 'sc challenge' for showing challenge chat and 'sc' for showing main chat"})
             return Response('liangjs said: Error happened! No!', 200)
@@ -263,8 +406,8 @@ class ListCommand(CommandHandler):
     def args():
         return []
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
 
         # get current CTF event
         event_name = CTF.get_event_from_group(chat_id)
@@ -298,11 +441,11 @@ class WorkCommand(CommandHandler):
         return []
 
     # TODO: mark other people as working on the challenge
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
 
         # get user who sends this message
-        uid = API.get_user_name(event['sender']['sender_id']['user_id'])
+        uid = API.get_user_name(event.sender.user_id)
         API.send_message(chat_id, {'text': \
             "{} is working on the challenge".format(uid)})
 
@@ -312,7 +455,7 @@ class WorkCommand(CommandHandler):
             API.send_message(chat_id, {'text': "Error: command should be used within chat associated with a challenge"})
             return Response('liangjs said: Error happened! No!', 200)
 
-        CTF.get_event(chall[0]).get_chall(chall[1]).add_person(uid)
+        CTF.add_person(chall[0], chall[1], uid)
         # TODO: may change
 
         API.send_message(chat_id, {'text': "You are now working on the challenge"})
@@ -323,8 +466,8 @@ class MarkCommands(CommandHandler):
     def args():
         return []
 
-    def handle_command_helper(self, cmd: List[str], event: Dict[str, Any], state: ChallState) -> Response:
-        chat_id = event['message']['chat_id']
+    def handle_command_helper(self, cmd: List[str], event: MessageEvent, state: ChallState) -> Response:
+        chat_id = event.message.chat_id
 
         # get current CTF challenge
         chall = CTF.get_chall_from_group(chat_id)
@@ -332,7 +475,7 @@ class MarkCommands(CommandHandler):
             API.send_message(chat_id, {'text': "Error: command should be used within chat associated with a challenge"})
             return Response('liangjs said: Error happened! No!', 200)
 
-        CTF.get_event(chall[0]).get_chall(chall[1]).state = state
+        CTF.set_state(chall[0], chall[1], state)
 
         API.send_message(chat_id, {'text': "Marking success"})
         return Response("OK", 200)
@@ -341,25 +484,150 @@ class SolvedCommand(MarkCommands):
     @staticmethod
     def help():
         return 'mark the challenge as solved'
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
         ret = self.handle_command_helper(cmd, event, ChallState.Solved)
-        API.send_message(event['message']['chat_id'], \
+        API.send_message(event.message.chat_id, \
             {'text': "Congratulation! The challenge is solved!"})
         return ret
 class StuckCommand(MarkCommands):
     @staticmethod
     def help():
         return 'mark the challenge as stuck'
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
         return self.handle_command_helper(cmd, event, ChallState.Stuck)
 class ProgressCommand(MarkCommands):
     @staticmethod
     def help():
         return 'mark the challenge as progress'
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
         return self.handle_command_helper(cmd, event, ChallState.Progress)
 
 
+class BroadcastCommand(CommandHandler):
+    @staticmethod
+    def help():
+        return 'send a message to all challenge chats of this event, #filter selects a category or state'
+
+    @staticmethod
+    def args():
+        return [CommandArg('#filter', True), CommandArg('message')]
+
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
+        if len(cmd) == 0:
+            API.send_message(chat_id, {'text': "Error: command should be 'bc [#category|#state] message'"})
+            return Response('liangjs said: Error happened! No!', 200)
+
+        # get current CTF event
+        event_name = CTF.get_event_from_group(chat_id)
+        if event_name is None:
+            API.send_message(chat_id, {'text': "Error: command should be used within chat associated with an event"})
+            return Response('liangjs said: Error happened! No!', 200)
+
+        # parse the optional filter
+        pred = None
+        if cmd[0].startswith('#') and len(cmd) > 1:
+            key = cmd[0][1:]
+            states = {s.value: s for s in ChallState}
+            if key.lower() in states:
+                state = states[key.lower()]
+                pred = lambda chall: chall.state == state
+            else:
+                category = key.capitalize()
+                pred = lambda chall: category in chall.categories
+            cmd = cmd[1:]
+        text = ' '.join(cmd)
+
+        chats = CTF.get_chall_chats(event_name, pred)
+        if len(chats) == 0:
+            API.send_message(chat_id, {'text': "Error: no challenge chat matches"})
+            return Response('liangjs said: Error happened! No!', 200)
+
+        # the whole fan-out happens in this callback, chats that do not
+        # fit into the budget are reported instead of sent later on
+        names = {v: k for k, v in chats.items()}
+        delivered, failed, rest = API.broadcast_message(chats.values(), \
+            {'text': '[broadcast] ' + text}, reserve=API.CALL_COST)
+
+        ret = "Broadcast delivered to {}/{} chats".format(len(delivered), len(chats))
+        if failed:
+            ret += "\nFailed: " + ", ".join(names[c] for c in failed)
+        if rest:
+            DEADLINE_MISSES[type(self).__name__] += 1
+            ret += "\nNot sent, out of time: " + ", ".join(names[c] for c in rest)
+        API.send_message(chat_id, {'text': ret})
+        return Response("OK", 200)
+
+
+class ArchiveCommand(CommandHandler):
+    @staticmethod
+    def help():
+        return 'archive a finished CTF event, it is reloaded when used again'
+
+    @staticmethod
+    def args():
+        return [CommandArg('CTF name', True)]
+
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
+        if len(cmd) > 1:
+            API.send_message(chat_id, {'text': "Error: command should be 'archive [event_name]'"})
+            return Response('liangjs said: Error happened! No!', 200)
+
+        if len(cmd) == 1:
+            event_name = cmd[0]
+        else:
+            event_name = CTF.get_event_from_group(chat_id)
+        if event_name is None or CTF.get_event(event_name) is None:
+            API.send_message(chat_id, {'text': "Error: no such CTF event"})
+            return Response('liangjs said: Error happened! No!', 200)
+
+        CTF.archive(event_name)
+        API.send_message(chat_id, {'text': "Archiving {} success!".format(event_name)})
+        return Response("OK", 200)
+
+
+class StatsCommand(CommandHandler):
+    @staticmethod
+    def help():
+        return 'show solve statistics of this event, or of all events outside an event chat'
+
+    @staticmethod
+    def args():
+        return []
+
+    @staticmethod
+    def format_seconds(t: Optional[float]) -> str:
+        if t is None:
+            return '-'
+        return '{}h{:02d}m'.format(int(t) // 3600, int(t) % 3600 // 60)
+
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        chat_id = event.message.chat_id
+        event_name = CTF.get_event_from_group(chat_id)
+        stats = CTF.timeline.stats(event_name)
+        fmt = self.format_seconds
+
+        ret = "Stats of {}:\n".format(event_name or 'all events')
+        ret += "Median solve time:\n"
+        for category, t in sorted(stats['median_solve_time'].items()):
+            ret += "  %s: %s\n" % (category, fmt(t))
+        ret += "Most stuck:\n"
+        for s in stats['most_stuck']:
+            ret += "  %s/%s: %s%s\n" % (s['event'], s['chall'], \
+                fmt(s['stuck_seconds']), ' (still stuck)' if s['stuck_now'] else '')
+        ret += "Most active: %s\n" % ", ".join( \
+            "%s(%d)" % p for p in stats['people'].items())
+        if event_name is not None:
+            ret += "Challenges (first worker / solve):\n"
+            for name, c in stats['challenges'].items():
+                ret += "  %s(%s): %s / %s\n" % (name, c['category'], \
+                    fmt(c['time_to_first_worker']), fmt(c['time_to_solve']))
+
+        API.send_message(chat_id, {'text': ret})
+        return Response("OK", 200)
+
+
 class HelpCommand(CommandHandler):
     @staticmethod
     def help():
@@ -369,7 +637,7 @@ class HelpCommand(CommandHandler):
     def args():
         return []
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
         cmds = {
             'new-chall': NewChallCommand,
             'nc': NewChallCommand,
@@ -383,12 +651,16 @@ class HelpCommand(CommandHandler):
             'solve': SolvedCommand,
             'stuck': StuckCommand,
             'progress': ProgressCommand,
-            'prog': ProgressCommand
+            'prog': ProgressCommand,
+            'broadcast': BroadcastCommand,
+            'bc': BroadcastCommand,
+            'archive': ArchiveCommand,
+            'stats': StatsCommand
         }
         ret = ""
         for k in cmds:
             ret += cmds[k]().usage(k)
-        API.send_message(event['message']['chat_id'], \
+        API.send_message(event.message.chat_id, \
             {'text': ret})
         return Response("OK", 200)
 
@@ -401,9 +673,14 @@ class DebugCommand(CommandHandler):
     def args():
         return []
 
-    def handle_command(self, cmd: List[str], event: Dict[str, Any]) -> Response:
-        API.send_message(event['message']['chat_id'], \
-            {'text': CTF.get_debug_info()})
+    def handle_command(self, cmd: List[str], event: MessageEvent) -> Response:
+        ret = CTF.get_debug_info()
+        ret += "deadline misses: {}\n".format(dict(DEADLINE_MISSES))
+        with PENDING_LOCK:
+            pending = list(PENDING_STEPS)
+        ret += "pending steps: {}\n".format(", ".join(map(str, pending)) or 'none')
+        API.send_message(event.message.chat_id, \
+            {'text': ret})
         return Response("OK", 200)
 
 class MessageReceiveEventHandler(FeishuEventHandler):
@@ -422,30 +699,41 @@ class MessageReceiveEventHandler(FeishuEventHandler):
         'stuck': StuckCommand(),
         'progress': ProgressCommand(),
         'prog': ProgressCommand(),
+        'broadcast': BroadcastCommand(),
+        'bc': BroadcastCommand(),
+        'archive': ArchiveCommand(),
+        'stats': StatsCommand(),
         'help': HelpCommand(),
         'debug': DebugCommand()
     }
 
-    def handle(self, event: Dict[str, Any]) -> Response:
-        def open_id_equals(mention):
-            return mention['id']['open_id']
+    def handle(self, raw_event: Dict[str, Any]) -> Response:
+        event = MessageEvent(raw_event)
 
-        if event['message'].get('mentions') is None or \
-            not all(map(
-            open_id_equals,
-            event['message']['mentions'])):
+        # reject before the content is ever decoded
+        if event.sender.sender_type != 'user' or \
+            not event.message.mentions_open_id(API.bot_info['open_id']):
             return Response('Bot: not my message')
 
-        chat_id = event['message']['chat_id']
+        chat_id = event.message.chat_id
         
         try:
-            content = json.loads(event['message']['content'])['text']
-            splits = content.split(maxsplit=1)
-            if len(splits) > 1:
-                cmd = splits[1]
+            cmd = event.message.command
+            if cmd:
                 for handler_cmd in self.HANDLERS.keys():
                     if cmd == handler_cmd or cmd.startswith(handler_cmd + ' '):
-                        return self.HANDLERS[handler_cmd].handle(event)
+                        handler = self.HANDLERS[handler_cmd]
+                        break
+                else:
+                    handler = None
+                if handler is not None:
+                    try:
+                        return handler.handle(event)
+                    except DeadlineExceeded as e:
+                        # no budget left to even report the error in chat
+                        DEADLINE_MISSES[type(handler).__name__] += 1
+                        logger.error('{} missed its deadline: {}'.format(cmd, e))
+                        return Response('liangjs said: Too slow! No!', 200)
             else:
                 cmd = '<empty>'
 
@@ -471,12 +759,28 @@ class EventCallbackHandler(FeishuHandler):
     }
 
     def handle(self, info: Dict[str, Any]) -> Response:
-        if not is_event_repeated(info['header']):
+        header = EventHeader(info['header'])
+        if not is_event_repeated(header):
             return Response('repeated event, ignore')
 
-        typ = info['header']['event_type']
+        typ = header.event_type
         if typ not in self.HANDLERS:
             raise FeishuHandlerException('unsupported event {}'.format(typ))
+
+        # age-based archiving, cheap unless an event is actually idle
+        for name in CTF.archive_idle():
+            logger.info('archived idle event {}'.format(name))
+
+        # rebuild state lost on a cold start, over several callbacks if needed
+        if REHYDRATE and not REHYDRATION.done:
+            try:
+                rehydrate(COMMAND_RESERVE)
+            except Exception as e:
+                logger.error('rehydrate failed: {} {}'.format(e, traceback.format_exc()))
+
+        # follow up on what earlier callbacks could not finish
+        run_pending_steps()
+
         event = info['event']
         return self.HANDLERS[typ].handle(event)
 
@@ -490,9 +794,15 @@ class FeishuMessageHandler:
 
     def __init__(self, req: Request):
         self.req = req
+        self.deadline = Deadline(CALLBACK_BUDGET)
 
     def handle_message(self) -> Response:
-        req: Dict[str, Any] = self.req.json
+        with self.deadline.activate():
+            return self.handle_message_in_budget()
+
+    def handle_message_in_budget(self) -> Response:
+        # decoded once here, everything below works on this
+        req: Dict[str, Any] = loads(self.req.get_data())
 
         typ: str = req.get('type', None) 
         if typ not in self.HANDLERS:
@@ -0,0 +1,113 @@
+from typing import Any, Dict, List, Optional, Tuple
+import re
+import threading
+from feishu_ctf.api import API, Deadline, FeishuException, logger
+from feishu_ctf.ctf import CTF
+
+# chats created by the bot follow these conventions:
+# - event main chat is named `{event}`, described as EVENT_CHAT_DESCRIPTION
+#   (older ones are described as just `{event}`)
+# - challenge chat is named `{event}-{chall}`, described as `{event}-{chall}: {category}`
+EVENT_CHAT_DESCRIPTION = '{} | doc: {}'
+EVENT_CHAT_PATTERN = re.compile(r'^(.+) \| doc: (\S+)$')
+
+
+def parse_chats(chats: List[Dict[str, Any]]):
+    """splits chats into events and challenges by their name and description.
+    returns ({event: (group_id, doc_token)}, [(event, chall, category, group_id)])
+    """
+    events: Dict[str, Tuple[str, Optional[str]]] = dict()
+    legacy: Dict[str, str] = dict()
+    candidates = []
+    for chat in chats:
+        name = chat.get('name') or ''
+        description = chat.get('description') or ''
+        m = EVENT_CHAT_PATTERN.match(description)
+        if m is not None and m.group(1) == name:
+            events[name] = (chat['chat_id'], m.group(2))
+        elif description == name:
+            legacy[name] = chat['chat_id']
+        elif description.startswith(name + ': ') and '-' in name:
+            candidates.append((name, description[len(name) + 2:], chat['chat_id']))
+
+    challs = []
+    for name, category, group_id in candidates:
+        # event names may contain '-' too, pick the longest known one
+        event = None
+        for i in range(len(name)):
+            if name[i] == '-' and (name[:i] in events or name[:i] in legacy):
+                event = name[:i]
+        if event is not None:
+            challs.append((event, name[len(event) + 1:], category, group_id))
+
+    # an old main chat is only trusted if it has challenges
+    for event, _, _, _ in challs:
+        if event not in events:
+            events[event] = (legacy[event], None)
+    return events, challs
+
+
+class Rehydration:
+    """rebuilds CtfManager from the chats the bot belongs to.
+
+    a step pages through chats as far as the budget allows and applies
+    whatever has been read so far, the next step continues from the saved
+    page. events and chats that are already known are left alone.
+
+    state and workers of challenges are only kept in memory, so
+    restored challenges come back open with nobody working on them.
+    """
+    def __init__(self) -> None:
+        self.chats: List[Dict[str, Any]] = []
+        self.page_token: Optional[str] = None
+        # all pages have been read and applied
+        self.done = False
+        self.lock = threading.Lock()
+
+    def step(self, reserve: float = 0.0) -> List[str]:
+        """runs one step, keeping `reserve` seconds of the current deadline.
+        returns the restored event names.
+        """
+        # another thread is already on it
+        if not self.lock.acquire(blocking=False):
+            return []
+        try:
+            deadline = Deadline.current()
+            def fits():
+                return deadline is None or deadline.fits(API.CALL_COST + reserve)
+
+            try:
+                while not self.done and fits():
+                    data = API.list_chats(self.page_token)
+                    self.chats.extend(data.get('items') or [])
+                    self.page_token = data.get('page_token')
+                    self.done = not data.get('has_more') or not self.page_token
+            except FeishuException as e:
+                logger.error('rehydrate stopped paging chats: {}'.format(e))
+            return self.apply()
+        finally:
+            self.lock.release()
+
+    def apply(self) -> List[str]:
+        """applies the chats read so far, returns the new events
+        """
+        events, challs = parse_chats(self.chats)
+        new_events = [k for k in events if not CTF.has_event(k)]
+        # challenges of archived events are left to the archive
+        new_challs = [c for c in challs if not CTF.has_group(c[3]) and \
+            (c[0] in new_events or CTF.is_loaded(c[0]))]
+
+        for name in new_events:
+            CTF.new_event(name, events[name][0], events[name][1])
+        for event, chall, category, group_id in new_challs:
+            CTF.add_challenge(event, chall, category, group_id)
+        if new_events or new_challs:
+            logger.info('rehydrated events {}, {} challenges'.format(new_events, len(new_challs)))
+        return new_events
+
+
+REHYDRATION = Rehydration()
+
+
+def rehydrate(reserve: float = 0.0) -> List[str]:
+    return REHYDRATION.step(reserve)
@@ -0,0 +1,302 @@
+from typing import Any, Dict, List, Optional, Tuple
+from array import array
+from bisect import insort
+from collections import Counter, defaultdict
+import heapq
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+# kinds of timeline entries, the argument of CREATE is the category
+# and the argument of PERSON is the person now working on the challenge
+CREATE = 0
+PERSON = 1
+STATE_KINDS = {'open': 2, 'progress': 3, 'stuck': 4, 'solved': 5}
+STUCK = STATE_KINDS['stuck']
+SOLVED = STATE_KINDS['solved']
+
+# the log file is a sequence of chunks, each one holds the challenges and
+# strings it introduces followed by its rows, column by column:
+# header (meta length, rows, crc32 of the rest), meta json, columns.
+# the meta is left out when the chunk introduces nothing
+CHUNK_HEADER = '<III'
+ROW_TYPES = ('d', 'B', 'I', 'i')
+
+
+def make_chunk(challs: List[Tuple[str, str]], strings: List[str], cols) -> bytes:
+    meta = b''
+    if challs or strings:
+        meta = json.dumps({'challs': challs, 'strings': strings},
+            separators=(',', ':')).encode()
+    payload = meta + b''.join(col.tobytes() for col in cols)
+    return struct.pack(CHUNK_HEADER, len(meta), len(cols[0]), zlib.crc32(payload)) + payload
+
+
+class Aggregates:
+    """statistics of one scope (a single event, or everything),
+    kept up to date on every entry instead of being computed from the log
+    """
+    __slots__ = ('challs', 'solve_times', 'stuck', 'people')
+
+    def __init__(self) -> None:
+        self.challs: List[int] = []
+        # maps category to sorted solve times in seconds
+        self.solve_times: Dict[str, List[float]] = defaultdict(list)
+        # challenges that have ever been stuck
+        self.stuck = set()
+        self.people = Counter()
+
+
+class Timeline:
+    """append-only log of challenge events, stored column-wise in arrays.
+
+    challenges are identified by their index in `_challs`, categories and
+    people by their index in `_strings`. the arrays only hold rows not yet
+    flushed to disk, queries are answered from the aggregates alone.
+    """
+    def __init__(self) -> None:
+        self.times = array(ROW_TYPES[0])
+        self.kinds = array(ROW_TYPES[1])
+        self.challs = array(ROW_TYPES[2])
+        self.args = array(ROW_TYPES[3])
+        self.lock = threading.Lock()
+        # rows, challenges and strings already on disk,
+        # and the size of the valid part of the file
+        self._flushed_rows = 0
+        self._flushed_challs = 0
+        self._flushed_strings = 0
+        self._file_size = 0
+        self._challs: List[Tuple[str, str]] = []
+        self._chall_ids: Dict[Tuple[str, str], int] = dict()
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = dict()
+
+        # per challenge, indexed by challenge id
+        self._category: Dict[int, str] = dict()
+        self._opened: Dict[int, float] = dict()
+        self._first_worker: Dict[int, float] = dict()
+        self._solved: Dict[int, float] = dict()
+        self._workers: Dict[int, set] = defaultdict(set)
+        self._stuck_since: Dict[int, float] = dict()
+        self._stuck_total: Dict[int, float] = defaultdict(float)
+
+        self._all = Aggregates()
+        self._events: Dict[str, Aggregates] = defaultdict(Aggregates)
+
+    def __len__(self) -> int:
+        return self._flushed_rows + len(self.times)
+
+    def _chall_id(self, event: str, chall: str) -> int:
+        key = (event, chall)
+        if key not in self._chall_ids:
+            self._chall_ids[key] = len(self._challs)
+            self._challs.append(key)
+        return self._chall_ids[key]
+
+    def _string_id(self, s: str) -> int:
+        if s not in self._string_ids:
+            self._string_ids[s] = len(self._strings)
+            self._strings.append(s)
+        return self._string_ids[s]
+
+    def _append(self, kind: int, event: str, chall: str, arg: int, t: Optional[float]) -> None:
+        t = time.time() if t is None else t
+        cid = self._chall_id(event, chall)
+        self.times.append(t)
+        self.kinds.append(kind)
+        self.challs.append(cid)
+        self.args.append(arg)
+        self._apply(t, kind, cid, arg)
+
+    def record_create(self, event: str, chall: str, category: str, t: Optional[float] = None) -> None:
+        with self.lock:
+            self._append(CREATE, event, chall, self._string_id(category), t)
+
+    def record_person(self, event: str, chall: str, person: str, t: Optional[float] = None) -> None:
+        with self.lock:
+            self._append(PERSON, event, chall, self._string_id(person), t)
+
+    def record_state(self, event: str, chall: str, state: str, t: Optional[float] = None) -> None:
+        with self.lock:
+            self._append(STATE_KINDS[state], event, chall, -1, t)
+
+    def _apply(self, t: float, kind: int, cid: int, arg: int) -> None:
+        scopes = (self._all, self._events[self._challs[cid][0]])
+        if kind == CREATE:
+            if cid in self._opened:
+                return
+            self._opened[cid] = t
+            self._category[cid] = self._strings[arg]
+            for scope in scopes:
+                scope.challs.append(cid)
+            return
+
+        if kind == PERSON:
+            person = self._strings[arg]
+            self._first_worker.setdefault(cid, t)
+            self._workers[cid].add(person)
+            for scope in scopes:
+                scope.people[person] += 1
+            return
+
+        # state transition, close a running stuck period first
+        if cid in self._stuck_since:
+            self._stuck_total[cid] += t - self._stuck_since.pop(cid)
+        if kind == STUCK:
+            self._stuck_since[cid] = t
+            for scope in scopes:
+                scope.stuck.add(cid)
+        elif kind == SOLVED and cid not in self._solved:
+            self._solved[cid] = t
+            for scope in scopes:
+                # without a creation time, e.g. a challenge restored
+                # from feishu, the solve time is unknown
+                if cid in self._opened:
+                    insort(scope.solve_times[self._category[cid]], t - self._opened[cid])
+                for person in self._workers[cid]:
+                    scope.people[person] += 1
+
+    def _scope(self, event: Optional[str]) -> Aggregates:
+        if event is None:
+            return self._all
+        return self._events.get(event) or Aggregates()
+
+    def median_solve_times(self, event: Optional[str] = None) -> Dict[str, float]:
+        ret = dict()
+        for category, times in self._scope(event).solve_times.items():
+            n = len(times)
+            ret[category] = times[n // 2] if n % 2 else (times[n // 2 - 1] + times[n // 2]) / 2
+        return ret
+
+    def most_stuck(self, event: Optional[str] = None, n: int = 5,
+        now: Optional[float] = None) -> List[Dict[str, Any]]:
+        now = time.time() if now is None else now
+        def stuck_for(cid):
+            ret = self._stuck_total[cid]
+            if cid in self._stuck_since:
+                ret += now - self._stuck_since[cid]
+            return ret
+        ret = []
+        for cid in heapq.nlargest(n, self._scope(event).stuck, key=stuck_for):
+            ret.append({'event': self._challs[cid][0],
+                'chall': self._challs[cid][1],
+                'stuck_seconds': stuck_for(cid),
+                'stuck_now': cid in self._stuck_since})
+        return ret
+
+    def challenge_times(self, event: str) -> Dict[str, Dict[str, Optional[float]]]:
+        """maps challenge name to its time to first worker and time to solve
+        """
+        ret = dict()
+        for cid in self._scope(event).challs:
+            opened = self._opened[cid]
+            first_worker = self._first_worker.get(cid)
+            solved = self._solved.get(cid)
+            ret[self._challs[cid][1]] = {
+                'category': self._category[cid],
+                'time_to_first_worker': None if first_worker is None else first_worker - opened,
+                'time_to_solve': None if solved is None else solved - opened}
+        return ret
+
+    def stats(self, event: Optional[str] = None) -> Dict[str, Any]:
+        ret = {
+            'median_solve_time': self.median_solve_times(event),
+            'most_stuck': self.most_stuck(event),
+            'people': dict(self._scope(event).people.most_common(10)),
+        }
+        if event is not None:
+            ret['challenges'] = self.challenge_times(event)
+        return ret
+
+    def flush(self, path: str) -> None:
+        """appends the buffered rows to the log file at `path` in place.
+        a crash while writing leaves a broken tail, which load stops at
+        and the next flush cuts off.
+        """
+        with self.lock:
+            if len(self.times) == 0:
+                return
+            chunk = make_chunk(self._challs[self._flushed_challs:],
+                self._strings[self._flushed_strings:], self._columns())
+            with open(path, 'ab') as f:
+                if f.tell() != self._file_size:
+                    f.truncate(self._file_size)
+                f.write(chunk)
+
+            self._file_size += len(chunk)
+            self._flushed_rows += len(self.times)
+            self._flushed_challs = len(self._challs)
+            self._flushed_strings = len(self._strings)
+            for col in self._columns():
+                del col[:]
+
+    def _columns(self):
+        return (self.times, self.kinds, self.challs, self.args)
+
+    @staticmethod
+    def load(path: str) -> 'Timeline':
+        """replays the log file at `path` to rebuild the aggregates.
+        reading stops at the first broken chunk. a file of several chunks
+        is rewritten as a single one, as every flush adds its own chunk.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        ret = Timeline()
+        head = struct.calcsize(CHUNK_HEADER)
+        row_size = sum(array(t).itemsize for t in ROW_TYPES)
+        rows = tuple(array(t) for t in ROW_TYPES)
+        chunks = 0
+        pos = 0
+        while pos < len(data):
+            try:
+                meta_len, n, crc = struct.unpack_from(CHUNK_HEADER, data, pos)
+                payload = data[pos + head:pos + head + meta_len + n * row_size]
+                if len(payload) != meta_len + n * row_size or zlib.crc32(payload) != crc:
+                    raise ValueError('broken chunk')
+                challs, strings = [], []
+                if meta_len > 0:
+                    meta = json.loads(payload[:meta_len].decode())
+                    challs = [(event, chall) for event, chall in meta['challs']]
+                    strings = list(meta['strings'])
+            except (struct.error, ValueError, KeyError, TypeError):
+                break
+
+            for event, chall in challs:
+                ret._chall_id(event, chall)
+            for s in strings:
+                ret._string_id(s)
+            cols = []
+            offset = meta_len
+            for t in ROW_TYPES:
+                col = array(t)
+                col.frombytes(payload[offset:offset + n * col.itemsize])
+                offset += n * col.itemsize
+                cols.append(col)
+            for row in zip(*cols):
+                ret._apply(*row)
+            for all_col, col in zip(rows, cols):
+                all_col.extend(col)
+
+            pos += head + len(payload)
+            chunks += 1
+            ret._flushed_rows += n
+        ret._flushed_challs = len(ret._challs)
+        ret._flushed_strings = len(ret._strings)
+        ret._file_size = pos
+
+        if chunks > 1:
+            chunk = make_chunk(ret._challs, ret._strings, rows)
+            tmp = path + '.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(chunk)
+                os.replace(tmp, path)
+                ret._file_size = len(chunk)
+            except OSError:
+                # still valid as it is, the next load tries again
+                pass
+        return ret